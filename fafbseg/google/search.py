@@ -82,8 +82,9 @@ def segments_to_neuron(seg_ids, autoseg_instance, name_pattern="Google: {id}",
 
     # Invert seg2skid
     skid2seg = {}
+    setdefault = skid2seg.setdefault
     for k, v in seg2skid.items():
-        skid2seg[v] = skid2seg.get(v, []) + [k]
+        setdefault(v, []).append(k)
 
     for n in nl:
         n.seg_ids = skid2seg[int(n.id)]
@@ -141,7 +142,8 @@ def segments_to_skids(seg_ids, autoseg_instance, name_pattern="Google: {id}",
 
     # Update map by those that could be found by name
     name2skid = by_name.set_index('name').skeleton_id.to_dict()
-    seg2skid.update({int(i): int(name2skid[n]) for i, n in zip(seg_ids, names) if n in by_name.name.values})
+    # (checking against the dict is O(1) - the names array would be scanned)
+    seg2skid.update({int(i): int(name2skid[n]) for i, n in zip(seg_ids, names) if n in name2skid})
 
     # Look for missing IDs
     not_found = [s for s in seg_ids if not seg2skid[int(s)]]
@@ -684,25 +686,36 @@ def find_missed_branches(x, autoseg_instance, tag=False, tag_size_thresh=10,
         autoseg_nodes = np.empty((0, 5))
 
     # Process fragments if any autoseg nodes left
-    data = []
     frags = navis.NeuronList([])
+    df = pd.DataFrame([], columns=['n_nodes', 'cable_length', 'node_id',
+                                   'node_loc', 'autoseg_skids'])
     if autoseg_nodes.shape[0]:
-        autoseg = navis.subset_neuron(union, autoseg_nodes)
-
-        # Split into fragments
-        frags = navis.break_fragments(autoseg)
+        # Subset to autoseg nodes and split into fragments
+        frags = move.merge_utils.subset_fragments(union, autoseg_nodes)
 
         # Generate summary
-        nodes = union.nodes.set_index('node_id')
-        for n in frags:
-            # Find parent node in union
-            pn = nodes.loc[n.root[0], 'parent_id']
-            pn_co = nodes.loc[pn, ['x', 'y', 'z']].values
-            org_skids = n.nodes.origin_skid.unique().tolist()
-            data.append([n.n_nodes, n.cable_length, pn, pn_co, org_skids])
-
-    df = pd.DataFrame(data, columns=['n_nodes', 'cable_length', 'node_id',
-                                     'node_loc', 'autoseg_skids'])
+        # Using positional indices into plain arrays is much cheaper than
+        # label-based lookups via .loc
+        node_ix = pd.Index(union.nodes.node_id.values)
+        parent_arr = union.nodes.parent_id.values
+        xyz_arr = union.nodes[['x', 'y', 'z']].values
+
+        # Find parent nodes in union for all fragments in one go
+        roots = np.array([n.root[0] for n in frags])
+        parents = parent_arr[node_ix.get_indexer(roots)]
+        parents_co = xyz_arr[node_ix.get_indexer(parents)]
+
+        # Build summary from typed columns (instead of a list of rows which
+        # forces pandas to infer dtypes from Python objects)
+        n_frags = len(frags)
+        df = pd.DataFrame({'n_nodes': np.fromiter((n.n_nodes for n in frags),
+                                                  dtype=int, count=n_frags),
+                           'cable_length': np.fromiter((n.cable_length for n in frags),
+                                                       dtype=float, count=n_frags),
+                           'node_id': parents,
+                           'node_loc': list(parents_co),
+                           'autoseg_skids': [n.nodes.origin_skid.unique().tolist() for n in frags]})
+
     df.sort_values('cable_length', ascending=False, inplace=True)
 
     if tag and not df.empty:
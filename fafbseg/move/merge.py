@@ -14,16 +14,17 @@
 #    GNU General Public License for more details.
 
 import numpy as np
+import pandas as pd
 import pymaid
 import navis
-import random
 
+from concurrent import futures
 from tqdm import tqdm
 
 from .. import utils
 from ..google import find_fragments
 
-from .merge_utils import collapse_nodes
+from .merge_utils import collapse_nodes, isin_sorted, remap_ids, subset_fragments
 from .interfaces import confirm_overlap
 
 import inquirer
@@ -124,7 +125,11 @@ def merge_into_catmaid(x, target_instance, tag, min_node_overlap=4, min_overlap_
                         If all went well.
     dict
                         If something failed, returns server responses with
-                        error logs.
+                        error logs. If an upload failed, the response has an
+                        additional ``orphaned_skeletons`` entry with the IDs
+                        of skeletons that were uploaded in parallel but not
+                        joined and should be cleaned up. If an exception is
+                        raised instead, these IDs are added to its arguments.
 
     Examples
     --------
@@ -194,24 +199,20 @@ def merge_into_catmaid(x, target_instance, tag, min_node_overlap=4, min_overlap_
     # interaction first and then run the automatic merge:
 
     # Start by find all overlapping fragments
-    overlapping = []
-    for n, m in tqdm(zip(x, mesh), desc='Pre-processing neuron(s)',
-                     leave=False, disable=not use_pbars, total=len(x)):
-        ol = find_fragments(n,
-                            min_node_overlap=min_node_overlap,
-                            min_nodes=min_overlap_size,
-                            mesh=m,
-                            remote_instance=target_instance)
-
-        if ol:
-            # Add number of samplers to each neuron
-            n_samplers = pymaid.get_sampler_counts(ol,
-                                                   remote_instance=target_instance)
-
-            for nn in ol:
-                nn.sampler_count = n_samplers[str(nn.id)]
-
-        overlapping.append(ol)
+    # These are independent (and mostly waiting for server responses)
+    # -> run them in parallel threads
+    with tqdm(total=len(x), desc='Pre-processing neuron(s)',
+              leave=False, disable=not use_pbars) as pbar:
+        with futures.ThreadPoolExecutor(max_workers=target_instance.max_threads) as ex:
+            ol_futures = [ex.submit(__find_overlapping, n,
+                                    mesh=m,
+                                    min_node_overlap=min_node_overlap,
+                                    min_overlap_size=min_overlap_size,
+                                    target_instance=target_instance)
+                          for n, m in zip(x, mesh)]
+            for f in futures.as_completed(ol_futures):
+                pbar.update(1)
+    overlapping = [f.result() for f in ol_futures]
 
     # Now have the user confirm merges before we actually make them
     viewer = navis.Viewer(title='Confirm merges')
@@ -259,23 +260,29 @@ def merge_into_catmaid(x, target_instance, tag, min_node_overlap=4, min_overlap_
                   flush=True)
             # Keep track of old skid
             original_skid = n.id
-            # Skeleton ID must stay convertable to integer
-            n.id = str(random.randint(1, 1000000))
+            # Use the next free ID after the overlapping fragments' IDs. Note
+            # that this has to be a string like the (pymaid) skeleton IDs in
+            # `ol`: mixed types would break comparisons of `origin_skeletons`
+            n.id = str(max(int(i) for i in ol.id) + 1)
             n._clear_temp_attr()
 
         # Check if there are any duplicate node IDs between neuron ``x`` and the
         # overlapping fragments and create new IDs for ``x`` if necessary
-        duplicated = n.nodes[n.nodes.node_id.isin(ol.nodes.node_id.values)]
-        if not duplicated.empty:
+        # (NeuronList.nodes concatenates all node tables -> only do that once)
+        ol_ids = ol.nodes.node_id.values
+        n_ids = n.nodes.node_id.values
+        is_dup = np.isin(n_ids, ol_ids)
+        if is_dup.any():
             print('Duplicate node IDs found. Regenerating node tables... ',
                   end='', flush=True)
-            max_ix = max(ol.nodes.node_id.max(), n.nodes.node_id.max()) + 1
-            new_ids = range(max_ix, max_ix + duplicated.shape[0])
-            id_map = {old: new for old, new in zip(duplicated.node_id, new_ids)}
-            n.nodes['node_id'] = n.nodes.node_id.map(lambda n: id_map.get(n, n))
-            n.nodes['parent_id'] = n.nodes.parent_id.map(lambda n: id_map.get(n, n))
+            max_ix = max(ol_ids.max(), n_ids.max()) + 1
+            old_ids = n_ids[is_dup]
+            new_ids = np.arange(max_ix, max_ix + old_ids.shape[0])
+            for col in ('node_id', 'parent_id'):
+                n.nodes[col] = remap_ids(n.nodes[col].values, old_ids, new_ids)
             if n.has_connectors:
-                n.connectors['node_id'] = n.connectors.node_id.map(lambda n: id_map.get(n, n))
+                n.connectors['node_id'] = remap_ids(n.connectors.node_id.values,
+                                                    old_ids, new_ids)
             n._clear_temp_attr()
             print('Done.', flush=True)
 
@@ -311,34 +318,53 @@ def merge_into_catmaid(x, target_instance, tag, min_node_overlap=4, min_overlap_
         new_nodes = union.nodes[union.nodes.origin_skeletons == n.id].node_id.values
         old_nodes = union.nodes[union.nodes.origin_skeletons != n.id].node_id.values
 
-        # Now remove the already existing nodes from the union
-        only_new = navis.subset_neuron(union, new_nodes)
-
-        # And then break into continuous fragments for upload
-        frags = navis.break_fragments(only_new)
+        # Now remove the already existing nodes from the union and break
+        # into continuous fragments for upload
+        frags = subset_fragments(union, new_nodes)
         print('Done.', flush=True)
 
         # Also get the new edges we need to generate
         to_stitch = new_edges[~new_edges.parent_id.isnull()]
 
-        # We need this later -> no need to compute this for every uploaded fragment
-        cond1b = to_stitch.node_id.isin(old_nodes)
-        cond2b = to_stitch.parent_id.isin(old_nodes)
+        # Grab the underlying arrays once and reuse them for every fragment
+        ts_nodes = to_stitch.node_id.values
+        ts_parents = to_stitch.parent_id.values
 
-        # Now upload each fragment and keep track of new node IDs
-        tn_map = {}
-        for f in tqdm(frags, desc='Merging new arbors', leave=False, disable=not use_pbars):
+        # We need this later -> no need to compute this for every uploaded fragment
+        old_sorted = np.sort(old_nodes)
+        cond1b = isin_sorted(ts_nodes, old_sorted)
+        cond2b = isin_sorted(ts_parents, old_sorted)
+
+        # Same goes for these lookup sets
+        # (using Python ints makes hashing/comparisons cheaper than numpy ints)
+        new_edge_nodes = set(new_edges.node_id.values.tolist())
+        new_edge_parents = set(new_edges.parent_id.values.tolist())
+
+        # Work out winner and looser for each join up front: make sure our
+        # base_neuron always comes out as winner on top
+        is_base = np.isin(ts_nodes, bn.nodes.node_id.values)
+        ts_winners = np.where(is_base, ts_nodes, ts_parents).tolist()
+        ts_loosers = np.where(is_base, ts_parents, ts_nodes).tolist()
+
+        # Keep track of which edges have already been joined
+        joined = np.zeros(to_stitch.shape[0], dtype=bool)
+
+        # Keep track of which nodes/parents have already been uploaded
+        # (updated with each fragment instead of re-checking all of tn_map)
+        cond1a = np.zeros(to_stitch.shape[0], dtype=bool)
+        cond2a = np.zeros(to_stitch.shape[0], dtype=bool)
+
+        # Figure out which fragments to upload
+        to_upload = []
+        for f in frags:
             # In cases of complete merging into existing neurons, the fragment
             # will have no nodes
             if f.n_nodes < 1:
                 continue
 
             # Check if fragment is a "linker" and as such can not be skipped
-            lcond1 = np.isin(f.nodes.node_id.values,
-                             new_edges.node_id.values)
-            lcond2 = np.isin(f.nodes.node_id.values,
-                             new_edges.parent_id.values)
-
+            lcond1 = f.nodes.node_id.isin(new_edge_nodes).values
+            lcond2 = f.nodes.node_id.isin(new_edge_parents).values
 
             # If not linker, check skip conditions
             if sum(lcond1) + sum(lcond2) <= 1:
@@ -359,14 +385,14 @@ def merge_into_catmaid(x, target_instance, tag, min_node_overlap=4, min_overlap_
                     else:
                         source_info['source_id'] = int(n.id)
                 else:
-                    if f.nodes.origin_skeletons.unique().shape[0] == 1:
-                        skid = f.nodes.origin_skeletons.unique()[0]
+                    codes, skids = pd.factorize(f.nodes.origin_skeletons.values)
+                    if skids.shape[0] == 1:
+                        skid = skids[0]
                     else:
                         print('Warning: uploading chimera fragment with multiple '
                               'skeleton IDs! Using largest contributor ID.')
                         # Use the skeleton ID that has the most nodes
-                        by_skid = f.nodes.groupby('origin_skeletons').x.count()
-                        skid = by_skid.sort_values(ascending=False).index.values[0]
+                        skid = skids[np.bincount(codes).argmax()]
 
                     source_info['source_id'] = int(skid)
 
@@ -377,66 +403,93 @@ def merge_into_catmaid(x, target_instance, tag, min_node_overlap=4, min_overlap_
                 # Unknown source
                 source_info = {}
 
-            resp = pymaid.upload_neuron(f,
-                                        import_tags=import_tags,
-                                        import_annotations=False,
-                                        import_connectors=True,
-                                        remote_instance=target_instance,
-                                        **source_info)
-
-            # Stop if there was any error while uploading
-            if 'error' in resp:
-                return resp
-
-            # Collect old -> new node IDs
-            tn_map.update(resp['node_id_map'])
-
-            # Now check if we can create any of the new edges by joining nodes
-            # Both treenode and parent ID have to be either existing nodes or
-            # newly uploaded
-            cond1a = to_stitch.node_id.isin(tn_map)
-            cond2a = to_stitch.parent_id.isin(tn_map)
-
-            to_gen = to_stitch.loc[(cond1a | cond1b) & (cond2a | cond2b)]
-
-            # Join nodes
-            for node in to_gen.itertuples():
-                # Make sure our base_neuron always come out as winner on top
-                if node.node_id in bn.nodes.node_id.values:
-                    winner, looser = node.node_id, node.parent_id
-                else:
-                    winner, looser = node.parent_id, node.node_id
-
-                # We need to map winner and looser to the new node IDs
-                winner = tn_map.get(winner, winner)
-                looser = tn_map.get(looser, looser)
-
-                # And now do the join
-                resp = pymaid.join_nodes(winner,
-                                         looser,
-                                         no_prompt=True,
-                                         tag_nodes=label_joins,
-                                         remote_instance=target_instance)
-
-                # See if there was any error while uploading
-                if 'error' in resp:
-                    print('Skipping joining nodes '
-                          '{} and {}: {} - '.format(node.node_id,
-                                                    node.parent_id,
-                                                    resp['error']))
-                    # Skip changing confidences
-                    continue
-
-                # Pop this edge from new_edges and from condition
-                new_edges.drop(node.Index, inplace=True)
-                cond1b.drop(node.Index, inplace=True)
-                cond2b.drop(node.Index, inplace=True)
+            to_upload.append((f, source_info))
 
-                # Change node confidences at new join
-                if label_joins:
-                    new_conf = {looser: 1}
-                    resp = pymaid.update_node_confidence(new_conf,
-                                                         remote_instance=target_instance)
+        # Now upload each fragment and keep track of new node IDs
+        # Uploads are independent of each other (and mostly waiting for the
+        # server) -> run them in parallel threads. Joins are still made in
+        # order, as soon as the fragments they need have been uploaded
+        # Note that we keep the number of parallel uploads small: these are
+        # heavy write requests for the CATMAID server
+        tn_map = {}
+        with futures.ThreadPoolExecutor(max_workers=min(8, target_instance.max_threads)) as ex:
+            up_futures = [ex.submit(pymaid.upload_neuron, f,
+                                    import_tags=import_tags,
+                                    import_annotations=False,
+                                    import_connectors=True,
+                                    remote_instance=target_instance,
+                                    **source_info)
+                          for f, source_info in to_upload]
+            for k, fut in enumerate(tqdm(up_futures, desc='Merging new arbors',
+                                         leave=False, disable=not use_pbars)):
+                # Any exception (including a keyboard interrupt) leaves the
+                # remaining uploads running -> cancel them and tell the user
+                # which skeletons they need to clean up before re-raising
+                try:
+                    resp = fut.result()
+
+                    # Stop if there was any error while uploading
+                    if 'error' in resp:
+                        resp['orphaned_skeletons'] = __abort_uploads(up_futures[k + 1:])
+                        return resp
+
+                    # Collect old -> new node IDs
+                    tn_map.update(resp['node_id_map'])
+
+                    # Now check if we can create any of the new edges by joining nodes
+                    # Both treenode and parent ID have to be either existing nodes or
+                    # newly uploaded
+                    uploaded = np.sort(np.array(list(resp['node_id_map'])))
+                    cond1a |= isin_sorted(ts_nodes, uploaded)
+                    cond2a |= isin_sorted(ts_parents, uploaded)
+
+                    # Combine conditions in place to avoid temporary arrays
+                    to_gen = np.logical_or(cond1a, cond1b)
+                    to_gen &= cond2a | cond2b
+                    to_gen &= ~joined
+                    to_gen = np.flatnonzero(to_gen)
+
+                    # Join nodes
+                    # Note that joins are made one at a time because each join
+                    # modifies the skeletons involved on the server
+                    new_conf = {}
+                    for i in to_gen.tolist():
+                        # We need to map winner and looser to the new node IDs
+                        winner = tn_map.get(ts_winners[i], ts_winners[i])
+                        looser = tn_map.get(ts_loosers[i], ts_loosers[i])
+
+                        # And now do the join
+                        resp = pymaid.join_nodes(winner,
+                                                 looser,
+                                                 no_prompt=True,
+                                                 tag_nodes=label_joins,
+                                                 remote_instance=target_instance)
+
+                        # See if there was any error while uploading
+                        if 'error' in resp:
+                            print('Skipping joining nodes '
+                                  '{} and {}: {} - '.format(ts_nodes[i],
+                                                            ts_parents[i],
+                                                            resp['error']))
+                            # Skip changing confidences
+                            continue
+
+                        # Mark this edge as done
+                        joined[i] = True
+
+                        # Lower node confidence at new join
+                        new_conf[looser] = 1
+
+                    # Change node confidences for all new joins in one go
+                    if label_joins and new_conf:
+                        resp = pymaid.update_node_confidence(new_conf,
+                                                             remote_instance=target_instance)
+                except BaseException as e:
+                    orphaned = __abort_uploads(up_futures[k + 1:])
+                    if orphaned:
+                        e.args += ('Orphaned skeletons (uploaded but not joined): '
+                                   '{}'.format(orphaned), )
+                    raise
 
         # Add annotations
         if n.has_annotations:
@@ -457,6 +510,53 @@ def merge_into_catmaid(x, target_instance, tag, min_node_overlap=4, min_overlap_
     return
 
 
+def __find_overlapping(n, mesh, min_node_overlap, min_overlap_size,
+                       target_instance):
+    """Find fragments overlapping with given neuron and add sampler counts."""
+    ol = find_fragments(n,
+                        min_node_overlap=min_node_overlap,
+                        min_nodes=min_overlap_size,
+                        mesh=mesh,
+                        remote_instance=target_instance)
+
+    if ol:
+        # Add number of samplers to each neuron
+        n_samplers = pymaid.get_sampler_counts(ol,
+                                               remote_instance=target_instance)
+
+        # Look up all counts at once, then assign
+        counts = [n_samplers[i] for i in ol.id.astype(str)]
+        for nn, c in zip(ol, counts):
+            nn.sampler_count = c
+
+    return ol
+
+
+def __abort_uploads(pending):
+    """Cancel pending uploads and return skeleton IDs of those that went through.
+
+    Uploads that were already running when we aborted still finish on the
+    server but will never be joined. We report their skeleton IDs so that
+    they can be cleaned up.
+
+    """
+    for fut in pending:
+        fut.cancel()
+
+    orphaned = []
+    for fut in pending:
+        if fut.cancelled():
+            continue
+        try:
+            resp = fut.result()
+        except BaseException:
+            continue
+        if 'error' not in resp and 'skeleton_id' in resp:
+            orphaned.append(resp['skeleton_id'])
+
+    return orphaned
+
+
 def __merge_annotations(n, bn, tag, target_instance):
     """Make sure proper annotations are added."""
     to_add = []
@@ -497,7 +597,7 @@ def update_node_radii(source, target, remote_instance, limit=2, skip_existing=Tr
     Returns
     -------
     dict
-                        Server response.
+                        Server response. Empty if there was nothing to update.
 
     """
     if not isinstance(source, (navis.TreeNeuron, navis.NeuronList)):
@@ -511,22 +611,36 @@ def update_node_radii(source, target, remote_instance, limit=2, skip_existing=Tr
     # Turn limit from microns to nanometres
     limit *= 1000
 
-    # First find the closest neighbor within distance limit for each node in target
-    # Find nodes in A to be merged into B
-    tree = navis.neuron2KDTree(source, tree_type='c', data='nodes')
-
+    # (for NeuronLists, `.nodes` concatenates all node tables -> do it once)
     nodes = target.nodes
+    node_ids = nodes.node_id.values
+    coords = nodes[['x', 'y', 'z']].values
     if skip_existing:
         # Extract nodes without a radius
-        nodes = nodes[nodes.radius <= 0]
+        no_radius = nodes.radius.values <= 0
+        node_ids, coords = node_ids[no_radius], coords[no_radius]
+
+    # Nothing to do -> skip building the tree and talking to the server
+    if not node_ids.shape[0]:
+        return {}
+
+    # First find the closest neighbor within distance limit for each node in target
+    # Find nodes in A to be merged into B
+    # (we query this tree only once, so we go for the faster build)
+    tree = navis.neuron2KDTree(source, tree_type='c', data='nodes',
+                               balanced_tree=False, compact_nodes=False)
 
     # For each node in A get the nearest neighbor in B
-    coords = nodes[['x', 'y', 'z']].values
-    nn_dist, nn_ix = tree.query(coords, k=1, distance_upper_bound=limit)
+    nn_dist, nn_ix = tree.query(coords, k=1, distance_upper_bound=limit,
+                                workers=-1)
 
     # Find nodes that are close enough to collapse
-    tn_ids = nodes.loc[nn_dist <= limit].node_id.values
-    new_radii = source.nodes.iloc[nn_ix[nn_dist <= limit]].radius.values
-
-    return pymaid.update_radii(dict(zip(tn_ids, new_radii)),
+    is_close = nn_dist <= limit
+    if not np.any(is_close):
+        return {}
+    tn_ids = node_ids[is_close]
+    new_radii = source.nodes.radius.values[nn_ix[is_close]]
+
+    # Converting to lists first is much cheaper than zipping numpy scalars
+    return pymaid.update_radii(dict(zip(tn_ids.tolist(), new_radii.tolist())),
                                remote_instance=remote_instance)
@@ -13,13 +13,17 @@
 #    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 #    GNU General Public License for more details.
 
-import itertools
 import pymaid
 import navis
+import scipy.sparse
+import scipy.sparse.csgraph
 import scipy.spatial
 
+from collections import defaultdict
+
 import networkx as nx
 import numpy as np
+import pandas as pd
 
 from .. import utils
 
@@ -30,6 +34,128 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 use_pbars = utils.use_pbars
 
 
+def remap_ids(ids, old, new):
+    """Map IDs from ``old`` to ``new`` leaving everything else untouched.
+
+    Parameters
+    ----------
+    ids :       np.ndarray
+                IDs to remap.
+    old :       np.ndarray
+                Unique IDs to be replaced.
+    new :       np.ndarray
+                New IDs. Must be of same length as ``old``.
+
+    Returns
+    -------
+    np.ndarray
+                Copy of ``ids`` with old IDs replaced by new ones.
+
+    """
+    ids = np.array(ids, copy=True)
+    old = np.asarray(old)
+    new = np.asarray(new)
+
+    if not old.shape[0]:
+        return ids
+
+    # Sort old IDs so that we can use a binary search instead of a dict
+    srt = np.argsort(old)
+    old, new = old[srt], new[srt]
+
+    ix = np.searchsorted(old, ids).clip(max=old.shape[0] - 1)
+    hit = old[ix] == ids
+    ids[hit] = new[ix[hit]]
+
+    return ids
+
+
+def isin_sorted(x, ids):
+    """Same as ``np.isin(x, ids)`` but uses a binary search on sorted ``ids``.
+
+    Sort ``ids`` once and reuse it when testing several arrays against the
+    same IDs.
+
+    Parameters
+    ----------
+    x :         np.ndarray
+                IDs to test.
+    ids :       np.ndarray
+                Sorted IDs to test against.
+
+    Returns
+    -------
+    np.ndarray
+                Boolean array of same shape as ``x``.
+
+    """
+    x = np.asarray(x)
+    if not ids.shape[0]:
+        return np.zeros(x.shape, dtype=bool)
+
+    ix = np.searchsorted(ids, x).clip(max=ids.shape[0] - 1)
+    return ids[ix] == x
+
+
+def subset_fragments(x, node_ids):
+    """Subset neuron to given nodes and break into continuous fragments.
+
+    This does the same as ``navis.break_fragments(navis.subset_neuron(x, node_ids))``
+    but works on the node table directly instead of going through the neuron's
+    graph.
+
+    Parameters
+    ----------
+    x :             TreeNeuron
+                    Neuron to subset.
+    node_ids :      list-like
+                    Node IDs to keep.
+
+    Returns
+    -------
+    NeuronList
+                    Continuous fragments sorted by size (largest first).
+
+    """
+    nodes = x.nodes[x.nodes.node_id.isin(node_ids)]
+    ids = nodes.node_id.values
+
+    # Nodes whose parent was removed become roots
+    has_parent = np.isin(nodes.parent_id.values, ids)
+    nodes = nodes.assign(parent_id=np.where(has_parent, nodes.parent_id.values, -1))
+
+    # Label connected components using the child -> parent edges
+    node_ix = pd.Index(ids)
+    child_ix = np.flatnonzero(has_parent)
+    parent_ix = node_ix.get_indexer(nodes.parent_id.values[has_parent])
+    adj = scipy.sparse.coo_matrix((np.ones(child_ix.shape[0]), (child_ix, parent_ix)),
+                                  shape=(ids.shape[0], ids.shape[0]))
+    _, labels = scipy.sparse.csgraph.connected_components(adj, directed=False)
+
+    if x.has_connectors:
+        cn_labels = np.full(x.connectors.shape[0], -1)
+        cn_ix = node_ix.get_indexer(x.connectors.node_id.values)
+        cn_labels[cn_ix >= 0] = labels[cn_ix[cn_ix >= 0]]
+        connectors = dict(list(x.connectors.groupby(cn_labels, sort=False)))
+
+    fragments = []
+    for l, this in nodes.groupby(labels, sort=False):
+        f = navis.TreeNeuron(this.reset_index(drop=True),
+                             name=x.name, id=x.id, units=x.units)
+        if x.has_connectors:
+            f.connectors = connectors.get(l, x.connectors.iloc[:0]).reset_index(drop=True)
+        if x.has_tags:
+            in_frag = set(this.node_id.values.tolist())
+            f.tags = {k: [n for n in v if n in in_frag] for k, v in x.tags.items()}
+            f.tags = {k: v for k, v in f.tags.items() if v}
+        fragments.append(f)
+
+    # Sort so that the first fragment is the largest
+    fragments = sorted(fragments, key=lambda f: f.n_nodes, reverse=True)
+
+    return navis.NeuronList(fragments)
+
+
 def collapse_nodes(A, B, limit=1, base_neuron=None, mesh=None):
     """Merge neuron A into neuron(s) B creating a union of both.
 
@@ -101,23 +227,32 @@ def collapse_nodes(A, B, limit=1, base_neuron=None, mesh=None):
         n.nodes['origin_skeletons'] = n.id
 
     # First make a weak union by simply combining the node tables
-    B.neurons = sorted(B.neurons, key=lambda x: {base_neuron: 0}.get(x, 2))
+    is_base = {base_neuron: 0}.get
+    B.neurons = sorted(B.neurons, key=lambda x: is_base(x, 2))
     union_simple = navis.stitch_neurons(B + A, method='NONE', master='FIRST')
 
     # Check for duplicate node IDs
     if any(union_simple.nodes.node_id.duplicated()):
         raise ValueError('Duplicate node IDs found.')
 
+    # Grab the node IDs and coordinates we need only once
+    # (for NeuronLists, `.nodes` concatenates all node tables on every call)
+    B_nodes = B.nodes
+    B_ids, B_co = B_nodes.node_id.values, B_nodes[['x', 'y', 'z']].values
+    A_ids, A_co = A.nodes.node_id.values, A.nodes[['x', 'y', 'z']].values
+
     # Find nodes in A to be merged into B
-    tree = scipy.spatial.cKDTree(data=B.nodes[['x', 'y', 'z']].values)
+    # (we query this tree only once, so we go for the faster build)
+    tree = scipy.spatial.cKDTree(data=B_co, balanced_tree=False, compact_nodes=False)
 
     # For each node in A get the nearest neighbor in B
-    coords = A.nodes[['x', 'y', 'z']].values
-    nn_dist, nn_ix = tree.query(coords, k=1, distance_upper_bound=limit)
+    nn_dist, nn_ix = tree.query(A_co, k=1, distance_upper_bound=limit,
+                                workers=-1)
 
     # Find nodes that are close enough to collapse
-    collapsed = A.nodes.loc[nn_dist <= limit].node_id.values
-    clps_into = B.nodes.iloc[nn_ix[nn_dist <= limit]].node_id.values
+    is_close = nn_dist <= limit
+    collapsed = A_ids[is_close]
+    clps_into = B_ids[nn_ix[is_close]]
 
     # If we have a mesh, check if those collapsed nodes are in sight of each
     # other
@@ -126,10 +261,8 @@ def collapse_nodes(A, B, limit=1, base_neuron=None, mesh=None):
         coll = ncollpyde.Volume(mesh.vertices, mesh.faces)
 
         # Produce start and end coordinates for the to collapse nodes
-        starts = A.nodes.set_index('node_id').loc[collapsed,
-                                                  ['x', 'y', 'z']].values
-        ends = B.nodes.set_index('node_id').loc[clps_into,
-                                                ['x', 'y', 'z']].values
+        starts = A_co[is_close]
+        ends = B_co[nn_ix[is_close]]
 
         # Check if the line between start and end intersects the mesh
         intersects, _, _ = coll.intersections(starts, ends)
@@ -143,83 +276,141 @@ def collapse_nodes(A, B, limit=1, base_neuron=None, mesh=None):
         clps_into = clps_into[not_intersects]
 
     # Generate a map of which node in A is to be collapsed into which node in B
-    clps_map = {n1: n2 for n1, n2 in zip(collapsed, clps_into)}
-
-    # The fastest way to collapse is to work on the edge list
-    E = nx.to_pandas_edgelist(union_simple.graph)
-
-    # Keep track of which edges were collapsed -> we will use this as weight
-    # later on to prioritize existing edges over newly generated ones
-    E['is_new'] = 1
-    source_in_B = E.source.isin(B.nodes.node_id.values)
-    target_in_B = E.target.isin(B.nodes.node_id.values)
-    E.loc[source_in_B | target_in_B, 'is_new'] = 0
-
-    # Now map collapsed nodes onto the nodes they collapsed into
-    E['target'] = E.target.map(lambda x: clps_map.get(x, x))
-    E['source'] = E.source.map(lambda x: clps_map.get(x, x))
-
-    # Make sure no self loops after collapsing. This happens if two adjacent
-    # nodes collapse onto the same target node
-    E = E[E.source != E.target]
-
-    # Remove duplicates. This happens e.g. when two adjaceny nodes merge into
-    # two other adjaceny nodes: A->B C->D ----> A/B->C/D
-    # By sorting first, we make sure original edges are kept first
-    E.sort_values('is_new', ascending=True, inplace=True)
+    # (converting to Python ints first is much cheaper than zipping numpy scalars)
+    clps_map = dict(zip(collapsed.tolist(), clps_into.tolist()))
 
-    # Because edges may exist in both directions (A->B and A<-B) we have to
-    # generate a column that's agnostic to directionality using frozensets
-    E['frozen_edge'] = E[['source', 'target']].apply(frozenset, axis=1)
-    E.drop_duplicates(['frozen_edge'], keep='first', inplace=True)
-
-    # Regenerate graph from these new edges
-    G = nx.Graph()
-    G.add_weighted_edges_from(E[['source', 'target', 'is_new']].values.astype(int))
-
-    # At this point there might still be disconnected pieces -> we will create
-    # separate neurons for each tree
-    props = union_simple.nodes.loc[union_simple.nodes.node_id.isin(G.nodes)].set_index('node_id')
-    nx.set_node_attributes(G, props.to_dict(orient='index'))
-    fragments = []
-    for n in nx.connected_components(G):
-        c = G.subgraph(n)
-        tree = nx.minimum_spanning_tree(c)
-        fragments.append(navis.graph.nx2neuron(tree,
-                                               name=base_neuron.name,
-                                               id=base_neuron.id))
-    fragments = navis.NeuronList(fragments)
-
-    if len(fragments) > 1:
+    if not clps_map:
+        # Nothing to collapse -> skip the edge list and just stitch the
+        # neurons together
         print('Union incomplete - watch out for disconnected fragments!')
-        # Now heal those fragments using a minimum spanning tree
-        union = navis.stitch_neurons(*fragments, method='ALL')
+        union = navis.stitch_neurons(B + A, method='ALL', master='FIRST')
     else:
-        union = fragments[0]
+        # The fastest way to collapse is to work on the edge list
+        # -> build it straight from the node table instead of going via the graph
+        # We keep the edge list as plain arrays: source, target and is_new
+        # (force integer IDs up front so that we never have to re-cast later)
+        not_root = union_simple.nodes.parent_id.values >= 0
+        src = union_simple.nodes.node_id.values[not_root].astype(np.int64)
+        tgt = union_simple.nodes.parent_id.values[not_root].astype(np.int64)
+
+        # Keep track of which edges were collapsed -> we will use this as weight
+        # later on to prioritize existing edges over newly generated ones
+        B_sorted = np.sort(B_ids)
+        is_new = ~isin_sorted(src, B_sorted)
+        is_new &= ~isin_sorted(tgt, B_sorted)
+
+        # Now map collapsed nodes onto the nodes they collapsed into
+        src = remap_ids(src, collapsed, clps_into)
+        tgt = remap_ids(tgt, collapsed, clps_into)
+
+        # Next we need to clean up the edge list:
+        # 1. Drop self loops. These happen if two adjacent nodes collapse onto
+        #    the same target node
+        # 2. Remove duplicates. This happens e.g. when two adjaceny nodes merge
+        #    into two other adjaceny nodes: A->B C->D ----> A/B->C/D
+        #    By (stable) sorting first, we make sure original edges are kept first
+        #    Because edges may exist in both directions (A->B and A<-B) we have to
+        #    compare pairs that are agnostic to directionality
+        order = np.flatnonzero(src != tgt)
+        # (is_new is binary, so a stable sort is just existing then new edges)
+        order = np.append(order[~is_new[order]], order[is_new[order]])
+        pairs = np.sort(np.stack([src[order], tgt[order]], axis=1), axis=1)
+        _, first = np.unique(pairs, axis=0, return_index=True)
+        keep = order[np.sort(first)]
+        src, tgt, is_new = src[keep], tgt[keep], is_new[keep]
+
+        # Generate the minimum spanning tree(s) on a sparse adjacency matrix
+        # Note that scipy ignores edges with weight 0, so existing edges get
+        # weight 1 and new edges weight 2 (this doesn't change the spanning tree)
+        codes, uniq = pd.factorize(np.append(src, tgt))
+        adj = scipy.sparse.coo_matrix((is_new + 1,
+                                       (codes[:src.shape[0]], codes[src.shape[0]:])),
+                                      shape=(uniq.shape[0], uniq.shape[0]))
+        mst = scipy.sparse.csgraph.minimum_spanning_tree(adj).tocoo()
+
+        # Node properties for all nodes in the edge list
+        # (all of which end up in the spanning forest)
+        props = union_simple.nodes.set_index('node_id').reindex(uniq)
+        props = props.drop(columns=['parent_id', 'type'], errors='ignore')
+
+        # The spanning forest tells us how many pieces we have
+        n_comp, labels = scipy.sparse.csgraph.connected_components(mst, directed=False)
+        root_ix = pd.Index(uniq).get_indexer(base_neuron.root[:1])[0]
+        if n_comp == 1 and root_ix >= 0:
+            # A single tree -> generate the node table straight from the
+            # spanning tree by walking it from the base neuron's root
+            # (no need to go through networkx or to reroot later)
+            _, pred = scipy.sparse.csgraph.breadth_first_order(mst, root_ix,
+                                                               directed=False,
+                                                               return_predecessors=True)
+            nodes = props.reset_index(drop=True)
+            nodes.insert(0, 'node_id', uniq)
+            nodes.insert(1, 'parent_id', np.where(pred >= 0, uniq[pred.clip(min=0)], -1))
+            union = navis.TreeNeuron(nodes, name=base_neuron.name, id=base_neuron.id)
+        else:
+            # At this point there are still disconnected pieces -> we will
+            # create separate neurons for each tree
+            # (setting attributes column by column avoids a nested dict per node)
+            G = nx.Graph()
+            G.add_edges_from(zip(uniq[mst.row], uniq[mst.col]))
+            for col in props.columns:
+                nx.set_node_attributes(G, dict(zip(uniq.tolist(),
+                                                   props[col].values.tolist())), name=col)
+
+            fragments = []
+            for i in range(n_comp):
+                tree = G.subgraph(uniq[labels == i])
+                fragments.append(navis.graph.nx2neuron(tree,
+                                                       name=base_neuron.name,
+                                                       id=base_neuron.id))
+            fragments = navis.NeuronList(fragments)
+
+            if len(fragments) > 1:
+                print('Union incomplete - watch out for disconnected fragments!')
+                # Now heal those fragments using a minimum spanning tree
+                union = navis.stitch_neurons(*fragments, method='ALL')
+            else:
+                union = fragments[0]
 
-    # Reroot to base neuron's root
-    union.reroot(base_neuron.root[0], inplace=True)
+    # Reroot to base neuron's root (if it isn't already)
+    if union.root[0] != base_neuron.root[0]:
+        union.reroot(base_neuron.root[0], inplace=True)
 
-    # Add tags back on
+    # Add tags back on (tags on collapsed nodes move to the surviving node)
+    # Several tagged nodes can collapse into the same node -> deduplicate each
+    # list while keeping its order
     if union_simple.has_tags:
         if not union.has_tags:
             union.tags = {}
-        union.tags.update(union_simple.tags)
+        clps_get = clps_map.get
+        union.tags.update({k: list(dict.fromkeys(clps_get(n, n) for n in v))
+                           for k, v in union_simple.tags.items()})
 
     # Add connectors back on
-    union.connectors = union_simple.connectors.drop_duplicates(subset='connector_id').copy()
-    union.connectors.loc[:, 'node_id'] = union.connectors.node_id.map(lambda x: clps_map.get(x, x))
+    # (deduplicate and remap in one go -> `assign` gives us a copy)
+    cn = union_simple.connectors
+    if not cn.connector_id.is_unique:
+        _, first = np.unique(cn.connector_id.values, return_index=True)
+        cn = cn.iloc[np.sort(first)]
+    union.connectors = cn.assign(node_id=remap_ids(cn.node_id.values,
+                                                   collapsed, clps_into))
 
     # Find the newly added edges (existing edges should not have been modified
     # - except for changing direction due to reroot)
     # The basic logic here is that new edges were only added between two
     # previously separate skeletons, i.e. where the skeleton ID changes between
     # parent and child node
-    node2skid = union_simple.nodes.set_index('node_id').origin_skeletons.to_dict()
-    union.nodes['parent_skeleton'] = union.nodes.parent_id.map(node2skid)
-    new_edges = union.nodes[union.nodes.origin_skeletons != union.nodes.parent_skeleton]
+    # -> look up parents by index instead of mapping through a dict
+    parent_ix = pd.Index(union_simple.nodes.node_id.values).get_indexer(union.nodes.parent_id.values)
+    has_parent = parent_ix >= 0
+    # Note: `take` keeps the dtype of the skeleton IDs (pymaid uses strings);
+    # routing them through a float array would make every comparison unequal
+    parent_skeleton = union_simple.nodes.origin_skeletons.take(np.where(has_parent, parent_ix, 0))
+    parent_skeleton.index = union.nodes.index
+    union.nodes['parent_skeleton'] = parent_skeleton.where(has_parent)
     # Remove root edges
-    new_edges = new_edges[~new_edges.parent_id.isnull()]
+    is_new = has_parent & (union.nodes.origin_skeletons.values != parent_skeleton.values)
+    new_edges = union.nodes[is_new]
 
     return union, new_edges, clps_map
 
@@ -264,8 +455,9 @@ def __collapse_nodes(*x, limit=1, base_neuron=None, priority_nodes=None):
     # Unpack neurons in *args
     x = pymaid.utils._unpack_neurons(x)
 
-    # Make sure we're working on copies and don't change originals
-    x = pymaid.CatmaidNeuronList([n.copy() for n in x])
+    # Note that we don't copy the neurons: nothing below modifies them in
+    # place (the union is generated from scratch)
+    x = pymaid.CatmaidNeuronList(x)
 
     if isinstance(priority_nodes, type(None)):
         priority_nodes = []
@@ -294,63 +486,118 @@ def __collapse_nodes(*x, limit=1, base_neuron=None, priority_nodes=None):
     if any(union_simple.nodes.node_id.duplicated()):
         raise ValueError('Duplicate node IDs found.')
 
-    # Map priority nodes -> this will speed things up later
-    is_priority = {n: True for n in priority_nodes}
-
-    # Go over each pair of fragments and check if they can be collapsed
-    comb = itertools.combinations(x, 2)
-    collapse_into = {}
-    new_edges = []
-    for c in comb:
-        tree = pymaid.neuron2KDTree(c[0], tree_type='c', data='nodes')
-
-        # For each node in master get the nearest neighbor in minion
-        coords = c[1].nodes[['x', 'y', 'z']].values
-        nn_dist, nn_ix = tree.query(coords, k=1, distance_upper_bound=limit)
-
-        clps_left = c[0].nodes.iloc[nn_ix[nn_dist <= limit]].node_id.values
-        clps_right = c[1].nodes.iloc[nn_dist <= limit].node_id.values
-        clps_dist = nn_dist[nn_dist <= limit]
-
-        for i, (n1, n2, d) in enumerate(zip(clps_left, clps_right, clps_dist)):
-            if is_priority.get(n1, False):
-                # If both nodes are priority nodes, don't collapse
-                if is_priority.get(n2, False):
-                    new_edges.append([n1, n2, d])
-                    # continue
-                else:
-                    collapse_into[n2] = n1
-            else:
-                collapse_into[n1] = n2
-
-    # Get the graph
-    G = union_simple.graph
-
-    # Add the new edges to graph
-    G.add_weighted_edges_from(new_edges)
+    # Build a single tree over the nodes of all fragments and keep track of
+    # which fragment each node belongs to
+    coords = np.vstack([n.nodes[['x', 'y', 'z']].values for n in x])
+    node_ids = np.concatenate([n.nodes.node_id.values for n in x])
+    frag_ix = np.concatenate([np.full(n.nodes.shape[0], i) for i, n in enumerate(x)])
+    # (we query this tree only once, so we go for the faster build)
+    tree = scipy.spatial.cKDTree(coords, balanced_tree=False, compact_nodes=False)
+
+    # Get all pairs of nodes within distance and drop within-fragment pairs
+    # Note that query_pairs always returns pairs with i < j, i.e. the first
+    # node belongs to the "left" fragment in terms of the original order
+    pairs = tree.query_pairs(limit, output_type='ndarray')
+    pairs = pairs[frag_ix[pairs[:, 0]] != frag_ix[pairs[:, 1]]]
+    dist = np.linalg.norm(coords[pairs[:, 0]] - coords[pairs[:, 1]], axis=1)
+
+    # For each node in the right fragment keep only its nearest neighbor in
+    # each of the left fragments
+    P = pd.DataFrame({'left': pairs[:, 0], 'right': pairs[:, 1], 'dist': dist,
+                      'frag_left': frag_ix[pairs[:, 0]],
+                      'frag_right': frag_ix[pairs[:, 1]]})
+    P = P.sort_values('dist', kind='mergesort').drop_duplicates(['right', 'frag_left'])
+    # Restore the order in which fragment pairs would be processed pairwise
+    # -> later collapses overwrite earlier ones
+    P = P.sort_values(['frag_left', 'frag_right', 'right'], kind='mergesort')
+
+    clps_left = node_ids[P.left.values]
+    clps_right = node_ids[P.right.values]
+    clps_dist = P.dist.values
+
+    # Decide which node collapses into which based on priority
+    prio_left = np.isin(clps_left, priority_nodes)
+    prio_right = np.isin(clps_right, priority_nodes)
+
+    # If both nodes are priority nodes, don't collapse but add new edge
+    both = prio_left & prio_right
+    new_edges = [[n1, n2, d] for n1, n2, d in zip(clps_left[both],
+                                                  clps_right[both],
+                                                  clps_dist[both])]
+
+    # Otherwise collapse non-priority into priority node
+    keys = np.where(prio_left, clps_right, clps_left)[~both]
+    values = np.where(prio_left, clps_left, clps_right)[~both]
+    collapse_into = dict(zip(keys.tolist(), values.tolist()))
+
+    # Arrays for remapping -> later collapses have overwritten earlier ones
+    clps_old = np.array(list(collapse_into.keys()), dtype=node_ids.dtype)
+    clps_new = np.array(list(collapse_into.values()), dtype=node_ids.dtype)
+
+    # If nothing collapses and no edges are added, the neurons can't be
+    # connected -> no need to go through the edge list to find out
+    if not collapse_into and not new_edges:
+        raise ValueError('Neuron still fragmented after collapsing nodes. '
+                         'Try increasing the `limit` parameter.')
 
     # Using an edge list is much more efficient than an adjacency matrix
-    E = nx.to_pandas_edgelist(G)
+    # -> build it straight from the node table instead of going via the graph
+    # (weights are the child -> parent distances as in pymaid's graph)
+    nodes = union_simple.nodes
+    nodes = nodes[~nodes.parent_id.isnull()]
+    parent_ix = pd.Index(union_simple.nodes.node_id.values).get_indexer(nodes.parent_id.values)
+    child_co = nodes[['x', 'y', 'z']].values
+    parent_co = union_simple.nodes[['x', 'y', 'z']].values[parent_ix]
+    E = pd.DataFrame({'source': nodes.node_id.values.astype(np.int64),
+                      'target': nodes.parent_id.values.astype(np.int64),
+                      'weight': np.linalg.norm(child_co - parent_co, axis=1)})
+
+    # Add the new edges to the edge list (instead of to the neuron's graph
+    # which would modify it in place)
+    if new_edges:
+        E = pd.concat([E, pd.DataFrame({'source': clps_left[both].astype(np.int64),
+                                        'target': clps_right[both].astype(np.int64),
+                                        'weight': clps_dist[both]})],
+                      ignore_index=True)
 
     # All nodes that collapse into other nodes need to have weight set to
     # float("inf") to de-prioritize them when generating the minimum spanning
     # tree later
-    clps_nodes = set(collapse_into.keys())
-    E.loc[(E.source.isin(clps_nodes)) | (E.target.isin(clps_nodes)), 'weight'] = float('inf')
+    clps_sorted = np.sort(clps_old)
+    is_clps = isin_sorted(E.source.values, clps_sorted)
+    is_clps |= isin_sorted(E.target.values, clps_sorted)
+    E['weight'] = np.where(is_clps, np.inf, E.weight.values)
 
     # Now map collapsed nodes onto the nodes they collapsed into
-    E['target'] = E.target.map(lambda x: collapse_into.get(x, x))
-    E['source'] = E.source.map(lambda x: collapse_into.get(x, x))
+    E['target'] = remap_ids(E.target.values, clps_old, clps_new)
+    E['source'] = remap_ids(E.source.values, clps_old, clps_new)
 
     # Make sure no self loops after collapsing. This happens if two adjacent
     # nodes collapse onto the same target node
     E = E[E.source != E.target]
 
-    # Turn this back into a graph
-    G_clps = nx.from_pandas_edgelist(E, edge_attr='weight')
+    # Drop duplicate edges (in either direction) keeping the cheapest one.
+    # Otherwise their weights would be summed up in the adjacency matrix
+    order = np.argsort(E.weight.values, kind='stable')
+    pairs = np.sort(np.stack([E.source.values[order],
+                              E.target.values[order]], axis=1), axis=1)
+    _, first = np.unique(pairs, axis=0, return_index=True)
+    E = E.iloc[order[np.sort(first)]]
+
+    # Build a single sparse adjacency matrix that we use to check for
+    # connectivity and to generate the spanning tree
+    # Note that scipy ignores edges with weight 0, so we add 1 to all weights
+    # (this doesn't change the spanning tree)
+    codes, uniq = pd.factorize(np.append(E.source.values, E.target.values))
+    adj = scipy.sparse.csr_matrix((E.weight.values + 1,
+                                   (codes[:E.shape[0]], codes[E.shape[0]:])),
+                                  shape=(uniq.shape[0], uniq.shape[0]))
 
     # Make sure that we are fully connected
-    if not nx.is_connected(G_clps):
+    # -> checking this on a sparse adjacency matrix is much faster than
+    # doing it in networkx
+    n_comp, _ = scipy.sparse.csgraph.connected_components(adj, directed=False)
+    if n_comp > 1:
         raise ValueError('Neuron still fragmented after collapsing nodes. '
                          'Try increasing the `limit` parameter.')
 
@@ -361,14 +608,18 @@ def __collapse_nodes(*x, limit=1, base_neuron=None, priority_nodes=None):
     # In doing so, we need to prioritize existing edges over new edges
     # otherwise we would have to cut existing neurons -> this is why we set
     # weight of new edges to float("inf") earlier on
-
-    # Generate the tree
-    tree = nx.minimum_spanning_tree(G_clps.to_undirected(as_view=True))
+    mst = scipy.sparse.csgraph.minimum_spanning_tree(adj).tocoo()
+    tree = nx.Graph()
+    tree.add_edges_from(zip(uniq[mst.row], uniq[mst.col]))
 
     # Add properties to nodes
-    survivors = np.unique(E[['source', 'target']])
-    props = union_simple.nodes.set_index('node_id').loc[survivors]
-    nx.set_node_attributes(tree, props.to_dict(orient='index'))
+    # (these are simply the unique nodes in the edge list we factorized above)
+    survivors = uniq
+    # (setting attributes column by column avoids a nested dict per node)
+    props = union_simple.nodes.set_index('node_id').reindex(survivors)
+    for col in props.columns:
+        nx.set_node_attributes(tree, dict(zip(survivors.tolist(),
+                                              props[col].values.tolist())), name=col)
 
     # Recreate neuron
     union = pymaid.graph.nx2neuron(tree,
@@ -376,14 +627,23 @@ def __collapse_nodes(*x, limit=1, base_neuron=None, priority_nodes=None):
                                    skeleton_id=union_simple.skeleton_id)
 
     # Add tags back on
+    tags = defaultdict(list, union.tags)
+    clps_get = collapse_into.get
     for n in x:
         if not n.has_tags:
             continue
-        union.tags.update({k: union.tags.get(k, []) + [collapse_into.get(a, a) for a in v] for k, v in n.tags.items()})
+        for k, v in n.tags.items():
+            tags[k].extend(clps_get(a, a) for a in v)
+    union.tags = dict(tags)
 
     # Add connectors back on
-    union.connectors = x.connectors.drop_duplicates(subset='connector_id')
-    union.connectors.node_id = union.connectors.node_id.map(lambda x: collapse_into.get(x, x))
+    # (deduplicate and remap in one go -> `assign` gives us a copy)
+    cn = x.connectors
+    if not cn.connector_id.is_unique:
+        _, first = np.unique(cn.connector_id.values, return_index=True)
+        cn = cn.iloc[np.sort(first)]
+    union.connectors = cn.assign(node_id=remap_ids(cn.node_id.values,
+                                                   clps_old, clps_new))
 
     # Return the last survivor
     return union, collapse_into, new_edges
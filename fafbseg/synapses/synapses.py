@@ -15,27 +15,42 @@
 
 import navis
 import os
+import pathlib
 import sqlite3
+import threading
+
+from concurrent import futures
 
 import networkx as nx
 import numpy as np
 import pandas as pd
+import scipy.sparse
+import scipy.sparse.csgraph
 
 from scipy.spatial import cKDTree
 from tqdm.auto import tqdm
 
 from .. import google
 
-conn = None
+# sqlite3 connections must not be shared across threads, so we keep one
+# connection per thread
+_local = threading.local()
+_filepath = None
 
 
 __all__ = ['query_synapses', 'query_connections', 'get_neuron_synapses',
-           'get_neuron_synapses', 'assign_connectors']
+           'get_neuron_synapses', 'assign_connectors', 'index_database']
 
 
 def get_connection(filepath=None, force_reconnect=False):
-    """Connect to SQL DB containg the synapses."""
-    global conn
+    """Connect to SQL DB containg the synapses.
+
+    Connections are read-only and cached per thread.
+
+    """
+    global _filepath
+
+    conn = getattr(_local, 'conn', None)
 
     # This prevents us from intializing many connections
     if conn and not force_reconnect:
@@ -46,18 +61,65 @@ def get_connection(filepath=None, force_reconnect=False):
         return conn
 
     if not filepath:
-        filepath = os.environ.get('BUHMANN_SYNAPSE_DB', None)
+        filepath = _filepath or os.environ.get('BUHMANN_SYNAPSE_DB', None)
 
     if not filepath:
         raise ValueError('Must provided filepath to SQL synapse database '
                          'either as `filepath` parameter or as '
                          '`BUHMANN_SYNAPSE_DB` environment variable.')
 
-    conn = sqlite3.connect(filepath)
+    # We only ever read from the database: opening it read-only spares us
+    # the locking and journaling overhead
+    uri = pathlib.Path(filepath).absolute().as_uri()
+    conn = sqlite3.connect(f'{uri}?mode=ro', uri=True)
+
+    # Default settings are tuned for small transactional workloads - we want
+    # a large page cache and memory-mapped reads instead
+    conn.execute('PRAGMA cache_size = -262144')  # in KiB -> 256MB
+    conn.execute('PRAGMA mmap_size = 30000000000')
+    conn.execute('PRAGMA temp_store = MEMORY')
+
+    _local.conn = conn
+    _filepath = filepath
 
     return conn
 
 
+def index_database(filepath=None):
+    """Add indices to the SQL synapse database to speed up queries.
+
+    Creates composite indices on (segment ID, cleft score) for both pre- and
+    postsynaptic segment IDs so that SQLite can look up synapses for a given
+    segment ID and filter by score without touching the table. This needs
+    write access to the database and only has to be run once.
+
+    Parameters
+    ----------
+    filepath :      str, optional
+                    Must point to SQL database containing the synapse data. If
+                    not provided will look for a `BUHMANN_SYNAPSE_DB`
+                    environment variable.
+
+    """
+    if not filepath:
+        filepath = _filepath or os.environ.get('BUHMANN_SYNAPSE_DB', None)
+
+    if not filepath:
+        raise ValueError('Must provided filepath to SQL synapse database '
+                         'either as `filepath` parameter or as '
+                         '`BUHMANN_SYNAPSE_DB` environment variable.')
+
+    # Our regular connections are read-only
+    with sqlite3.connect(filepath) as conn:
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_synlinks_pre_score '
+                     'ON synlinks(segmentid_pre, cleft_scores)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_synlinks_post_score '
+                     'ON synlinks(segmentid_post, cleft_scores)')
+        # Gather statistics for the query planner
+        conn.execute('ANALYZE synlinks')
+    conn.close()
+
+
 def query_synapses(seg_ids, pre=True, post=True, score_thresh=30, ret='brief',
                    downcast=True, db=None):
     """Fetch synapses for given segment IDs.
@@ -93,10 +155,15 @@ def query_synapses(seg_ids, pre=True, post=True, score_thresh=30, ret='brief',
 
     conn = get_connection(db)
 
+    if not pre and not post:
+        raise ValueError('`pre` and `post` must not both be False')
+
     seg_ids = navis.utils.make_iterable(seg_ids)
 
-    # Turn into query string
-    seg_ids_str = f'{",".join(seg_ids.astype(str))}'
+    # Instead of inlining potentially thousands of IDs into the query, we
+    # write them to a temporary table which SQLite can probe efficiently
+    _ids_to_temp_table(seg_ids, '_segids', conn)
+    seg_ids_sel = 'SELECT id FROM _segids'
 
     # Create query
     if ret == 'brief':
@@ -106,25 +173,39 @@ def query_synapses(seg_ids, pre=True, post=True, score_thresh=30, ret='brief',
         cols = ['*']
     sel = f'SELECT {", ".join(cols)} from synlinks'
 
+    score = f' AND cleft_scores >= {score_thresh}' if score_thresh else ''
+
     if pre and post:
-        where = f'WHERE (segmentid_pre IN ({seg_ids_str}) OR segmentid_post in ({seg_ids_str}))'
+        # SQLite can't always use separate indices for the two halves of an
+        # OR, so we query them separately. The second half excludes rows
+        # already returned by the first half to avoid duplicates
+        query = (f'{sel} WHERE segmentid_pre IN ({seg_ids_sel}){score} '
+                 'UNION ALL '
+                 f'{sel} WHERE segmentid_post IN ({seg_ids_sel}) '
+                 f'AND segmentid_pre NOT IN ({seg_ids_sel}){score}')
     elif pre:
-        where = f'WHERE segmentid_pre IN ({seg_ids_str})'
-    elif post:
-        where = f'WHERE segmentid_post IN ({seg_ids_str})'
+        query = f'{sel} WHERE segmentid_pre IN ({seg_ids_sel}){score}'
     else:
-        raise ValueError('`pre` and `post` must not both be False')
+        query = f'{sel} WHERE segmentid_post IN ({seg_ids_sel}){score}'
 
-    if score_thresh:
-        where += f' AND cleft_scores >= {score_thresh}'
+    return _query_database(f'{query};', conn, downcast=downcast)
+
+
+def _ids_to_temp_table(ids, table, conn):
+    """Write IDs to a temporary table (replacing any previous content)."""
+    conn.execute(f'CREATE TEMP TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY)')
+    conn.execute(f'DELETE FROM {table}')
+    conn.executemany(f'INSERT OR IGNORE INTO {table} VALUES (?)',
+                     zip(np.asarray(ids).tolist()))
+    conn.commit()
 
-    return _query_database(f'{sel} {where};', conn, downcast=downcast)
 
+def _query_database(query, conn, downcast=True, chunksize=200000):
+    """Query the synapse database.
 
-def _query_database(query, conn, downcast=True):
-    """Query the synapse database."""
-    resp = pd.read_sql(query, conn)
+    Results are fetched and downcast in chunks to keep peak memory low.
 
+    """
     # Fix some data types
     # A lot of these come out at 64 bit but with the exception of
     # segmentation IDs 32 bit is more than enough
@@ -149,11 +230,17 @@ def _query_database(query, conn, downcast=True):
               'offset': np.int32
               }
 
-    if downcast:
-        to_conv = {k: v for k, v in DTYPES.items() if k in resp.columns}
-        resp = resp.astype(to_conv, errors='ignore')
+    chunks = []
+    for resp in pd.read_sql(query, conn, chunksize=chunksize):
+        if downcast:
+            to_conv = {k: v for k, v in DTYPES.items() if k in resp.columns}
+            resp = resp.astype(to_conv, errors='ignore')
+        chunks.append(resp)
+
+    if len(chunks) == 1:
+        return chunks[0]
 
-    return resp
+    return pd.concat(chunks, axis=0, ignore_index=True)
 
 
 def query_connections(pre_ids, post_ids, score_thresh=30, ret='brief',
@@ -190,11 +277,11 @@ def query_connections(pre_ids, post_ids, score_thresh=30, ret='brief',
     conn = get_connection(db)
 
     pre_ids = navis.utils.make_iterable(pre_ids)
-    post_ids = navis.utils.make_iterable(pre_ids)
+    post_ids = navis.utils.make_iterable(post_ids)
 
-    # Turn into query string
-    pre_ids_str = f'{",".join(pre_ids.astype(str))}'
-    post_ids_str = f'{",".join(post_ids.astype(str))}'
+    # Write IDs to temporary tables instead of inlining them into the query
+    _ids_to_temp_table(pre_ids, '_preids', conn)
+    _ids_to_temp_table(post_ids, '_postids', conn)
 
     # Create query
     if ret == 'brief':
@@ -204,7 +291,8 @@ def query_connections(pre_ids, post_ids, score_thresh=30, ret='brief',
         cols = ['*']
     sel = f'SELECT {", ".join(cols)} from synlinks'
 
-    where = f'WHERE (segmentid_pre IN ({pre_ids_str}) AND segmentid_post in ({post_ids_str}))'
+    where = ('WHERE (segmentid_pre IN (SELECT id FROM _preids) '
+             'AND segmentid_post in (SELECT id FROM _postids))')
 
     if score_thresh:
         where += f' AND cleft_scores >= {score_thresh}'
@@ -321,44 +409,15 @@ def get_neuron_synapses(x, pre=True, post=True, collapse_connectors=False,
         syn = syn[syn.segmentid_pre != syn.segmentid_post]
 
     if drop_duplicates:
-        dupl_thresh = 250
-        # Deal with pre- and postsynapses separately
-        while True:
-            # Generate pairs of pre- and postsynaptic coordinates that are
-            # suspiciously close
-            pre_tree = cKDTree(syn[['pre_x', 'pre_y', 'pre_z']].values)
-            post_tree = cKDTree(syn[['post_x', 'post_y', 'post_z']].values)
-            pre_pairs = pre_tree.query_pairs(r=dupl_thresh)
-            post_pairs = post_tree.query_pairs(r=dupl_thresh)
-
-            # We will consider pairs for removal where both pre- OR postsynapse
-            # are close - this is easy to change via below operator
-            pairs = pre_pairs | post_pairs  # union of both
-            pairs = np.array(list(pairs))
-
-            # For each pair check if they connect the same IDs
-            same_pre = syn.iloc[pairs[:, 0]].segmentid_pre.values == syn.iloc[pairs[:, 1]].segmentid_pre.values
-            same_post = syn.iloc[pairs[:, 0]].segmentid_post.values == syn.iloc[pairs[:, 1]].segmentid_post.values
-            same_cn = same_pre & same_post
-
-            # If no more pairs to collapse break
-            if same_cn.sum() == 0:
-                break
-
-            # Generate a graph from pairs
-            G = nx.Graph()
-            G.add_edges_from(pairs[same_cn])
-
-            # Find the minimum number of nodes we need to remove
-            # to separate the connectors
-            to_rm = []
-            for cn in nx.connected_components(G):
-                to_rm += list(nx.minimum_node_cut(nx.subgraph(G, cn)))
-
-            # Drop those nodes
-            syn = syn.drop(index=syn.index.values[to_rm])
+        # We will consider pairs for removal where both pre- OR postsynapse
+        # are close
+        syn = _drop_duplicate_synapses(syn,
+                                       loc_cols=[['pre_x', 'pre_y', 'pre_z'],
+                                                 ['post_x', 'post_y', 'post_z']],
+                                       dist=250)
+
         # Reset index
-        syn.reset_index(drop=True, inplace=True)
+        syn = syn.reset_index(drop=True)
 
     if collapse_connectors:
         assign_connectors(syn)
@@ -366,100 +425,156 @@ def get_neuron_synapses(x, pre=True, post=True, collapse_connectors=False,
         # Make fake IDs
         syn['connector_id'] = np.arange(syn.shape[0]).astype(np.int32)
 
+    # Map segment IDs to rows in the synapse table once instead of scanning
+    # the whole table for each neuron
+    pre_idx = syn.groupby('segmentid_pre', sort=False).indices
+    post_idx = syn.groupby('segmentid_post', sort=False).indices
+
     # Now associate synapses with neurons
-    tables = []
-    for c in tqdm(seg_ids.columns,
-                  desc='Proc. neurons',
-                  disable=not progress or seg_ids.shape[1] == 1,
-                  leave=False):
-        this_segs = seg_ids.loc[seg_ids[c].notnull(), c]
-        is_pre = syn.segmentid_pre.isin(this_segs.index.values)
-        is_post = syn.segmentid_post.isin(this_segs.index.values)
-
-        # At this point we might see the exact same connection showing up in
-        # `is_pre` and in `is_post`. This happens when we mapped both the
-        # pre- and the postsynaptic segment to this neuron - likely an error.
-        # In these cases we have to decide whether our neuron is truely pre-
-        # or postsynaptic. For this we will use the overlap counts:
-        # First find connections that would show up twice
-        is_dupl = is_pre & is_post
-        if any(is_dupl):
-            dupl = syn[is_dupl]
-            # Next get the overlap counts for the pre- and postsynaptic seg IDs
-            dupl_pre_ol = seg_ids.loc[dupl.segmentid_pre, c].values
-            dupl_post_ol = seg_ids.loc[dupl.segmentid_post, c].values
-
-            # We go for the one with more overlap
-            true_pre = dupl_pre_ol > dupl_post_ol
-
-            # Propagate that decision
-            is_pre[is_dupl] = true_pre
-            is_post[is_dupl] = ~true_pre
-
-        # Now get our synapses
-        this_pre = syn[is_pre]
-        this_post = syn[is_post]
-
-        # Keep only one connector per presynapse
-        # -> just like in CATMAID connector tables
-        # Postsynaptic connectors will still show up multiple times
-        if collapse_connectors:
-            this_pre = this_pre.drop_duplicates('connector_id')
-
-        # Combine pre- and postsynapses and keep track of the type
-        connectors = pd.concat([this_pre, this_post], axis=0).reset_index(drop=True)
-        connectors['type'] = 'post'
-        connectors.iloc[:this_pre.shape[0],
-                        connectors.columns.get_loc('type')] = 'pre'
-        connectors['type'] = connectors['type'].astype('category')
-
-        # Rename columns such that x/y/z corresponds to presynaptic sites
-        connectors.rename({'pre_x': 'x', 'pre_y': 'y', 'pre_z': 'z'},
-                          axis=1, inplace=True)
-
-        # For CATMAID-like connector tables subset to relevant columns
-        if ret == 'catmaid':
-            connectors = connectors[['connector_id', 'x', 'y', 'z',
-                                     'cleft_scores', 'type']].copy()
-
-        # Map connectors to nodes
-        # Note that this is where we enforce `dist_thresh`
-        neuron = x.idx[c]
-        tree = navis.neuron2KDTree(neuron)
-        dist, ix = tree.query(connectors[['x', 'y', 'z']].values,
-                              distance_upper_bound=dist_thresh)
-
-        # Drop far away connectors
-        connectors = connectors.loc[dist < np.inf]
-
-        # Assign node IDs
-        connectors['node_id'] = neuron.nodes.iloc[ix[dist < np.inf]].node_id.values
-
-        # Somas can end up having synapses, which we know is wrong and is
-        # relatively easy to fix
-        if np.any(neuron.soma):
-            somata = navis.utils.make_iterable(neuron.soma)
-            s_locs = neuron.nodes.loc[neuron.nodes.node_id.isin(somata),
-                                      ['x', 'y', 'z']].values
-            # Find all nodes within 2 micron around the somas
-            soma_node_ix = tree.query_ball_point(s_locs, r=2000)
-            soma_node_ix = [n for l in soma_node_ix for n in l]
-            soma_node_id = neuron.nodes.iloc[soma_node_ix].node_id.values
-
-            # Drop connectors attached to these soma nodes
-            connectors = connectors[~connectors.node_id.isin(soma_node_id)]
-
-        if attach:
-            neuron.connectors = connectors.reset_index(drop=True)
-        else:
-            connectors['neuron'] = neuron.id  # do NOT change the type of this
-            tables.append(connectors)
-
-    if not attach:
-        connectors = pd.concat(tables, axis=0, sort=True).reset_index(drop=True)
+    # Neurons are processed independently and the expensive bits (building
+    # and querying KD-trees) release the GIL, so we can use threads
+    with futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        futs = [ex.submit(_neuron_connectors,
+                          neuron=x.idx[c],
+                          this_segs=seg_ids.loc[seg_ids[c].notnull(), c],
+                          syn=syn,
+                          pre_idx=pre_idx,
+                          post_idx=post_idx,
+                          collapse_connectors=collapse_connectors,
+                          dist_thresh=dist_thresh,
+                          ret=ret) for c in seg_ids.columns]
+
+        tables = [f.result() for f in tqdm(futs,
+                                           desc='Proc. neurons',
+                                           disable=not progress or seg_ids.shape[1] == 1,
+                                           leave=False)]
+
+    if attach:
+        for c, connectors in zip(seg_ids.columns, tables):
+            x.idx[c].connectors = connectors.reset_index(drop=True)
+    else:
+        for c, connectors in zip(seg_ids.columns, tables):
+            connectors['neuron'] = x.idx[c].id  # do NOT change the type of this
+        # All tables share the same columns (and `type` categories), so
+        # there is nothing to align or re-encode here
+        connectors = pd.concat(tables, axis=0, sort=False, ignore_index=True)
         return connectors
 
 
+def _neuron_connectors(neuron, this_segs, syn, pre_idx, post_idx,
+                       collapse_connectors, dist_thresh, ret):
+    """Extract synapses for a single neuron and map them to its nodes.
+
+    Parameters
+    ----------
+    neuron :        navis.TreeNeuron
+                    Neuron to map synapses to.
+    this_segs :     pd.Series
+                    Overlap counts for the neuron's segments indexed by
+                    segment ID.
+    syn :           pd.DataFrame
+                    Synapses to pick from.
+    pre_idx/post_idx : dict
+                    Maps pre- and postsynaptic segment IDs to row indices in
+                    ``syn``.
+
+    See ``get_neuron_synapses`` for the remaining parameters.
+
+    Returns
+    -------
+    connectors :    pd.DataFrame
+
+    """
+    this_seg_ids = this_segs.index.values.tolist()
+    is_pre = np.zeros(syn.shape[0], dtype=bool)
+    is_pre[_rows_for_ids(this_seg_ids, pre_idx)] = True
+    is_post = np.zeros(syn.shape[0], dtype=bool)
+    is_post[_rows_for_ids(this_seg_ids, post_idx)] = True
+
+    # At this point we might see the exact same connection showing up in
+    # `is_pre` and in `is_post`. This happens when we mapped both the
+    # pre- and the postsynaptic segment to this neuron - likely an error.
+    # In these cases we have to decide whether our neuron is truely pre-
+    # or postsynaptic. For this we will use the overlap counts:
+    # First find connections that would show up twice
+    is_dupl = is_pre & is_post
+    if np.any(is_dupl):
+        dupl = syn[is_dupl]
+        # Next get the overlap counts for the pre- and postsynaptic seg IDs
+        dupl_pre_ol = this_segs.loc[dupl.segmentid_pre].values
+        dupl_post_ol = this_segs.loc[dupl.segmentid_post].values
+
+        # We go for the one with more overlap
+        true_pre = dupl_pre_ol > dupl_post_ol
+
+        # Propagate that decision
+        is_pre[is_dupl] = true_pre
+        is_post[is_dupl] = ~true_pre
+
+    # Now get our synapses
+    this_pre = syn[is_pre]
+    this_post = syn[is_post]
+
+    # Keep only one connector per presynapse
+    # -> just like in CATMAID connector tables
+    # Postsynaptic connectors will still show up multiple times
+    if collapse_connectors:
+        this_pre = this_pre.drop_duplicates('connector_id')
+
+    # Combine pre- and postsynapses and keep track of the type
+    connectors = pd.concat([this_pre, this_post], axis=0).reset_index(drop=True)
+    codes = np.repeat(np.array([0, 1], dtype=np.int8),
+                      [this_pre.shape[0], this_post.shape[0]])
+    connectors['type'] = pd.Categorical.from_codes(codes,
+                                                   categories=['pre', 'post'])
+
+    # Rename columns such that x/y/z corresponds to presynaptic sites
+    connectors.rename({'pre_x': 'x', 'pre_y': 'y', 'pre_z': 'z'},
+                      axis=1, inplace=True)
+
+    # For CATMAID-like connector tables subset to relevant columns
+    if ret == 'catmaid':
+        connectors = connectors[['connector_id', 'x', 'y', 'z',
+                                 'cleft_scores', 'type']].copy()
+
+    # Map connectors to nodes
+    # Note that this is where we enforce `dist_thresh`
+    tree = navis.neuron2KDTree(neuron, balanced_tree=False, compact_nodes=False)
+    dist, ix = tree.query(connectors[['x', 'y', 'z']].values,
+                          distance_upper_bound=dist_thresh)
+
+    # Drop far away connectors
+    is_close = dist < np.inf
+    connectors = connectors.loc[is_close]
+
+    # Assign node IDs
+    node_ids = neuron.nodes.node_id.values
+    connectors['node_id'] = node_ids[ix[is_close]]
+
+    # Somas can end up having synapses, which we know is wrong and is
+    # relatively easy to fix
+    if np.any(neuron.soma):
+        somata = navis.utils.make_iterable(neuron.soma)
+        s_locs = neuron.nodes[['x', 'y', 'z']].values[np.isin(node_ids, somata)]
+        # Find all nodes within 2 micron around the somas
+        soma_node_ix = tree.query_ball_point(s_locs, r=2000)
+        soma_node_ix = [n for l in soma_node_ix for n in l]
+        soma_node_id = node_ids[soma_node_ix]
+
+        # Drop connectors attached to these soma nodes
+        connectors = connectors[~np.isin(connectors.node_id.values, soma_node_id)]
+
+    return connectors
+
+
+def _rows_for_ids(ids, groups):
+    """Collect row indices for given IDs from a ``groupby().indices`` dict."""
+    rows = [groups[i] for i in ids if i in groups]
+    if not rows:
+        return np.array([], dtype=int)
+    return np.concatenate(rows)
+
+
 def get_neuron_connections(sources, targets=None, agglomerate=True,
                            score_thresh=30, ol_thresh=5, dist_thresh=2000,
                            drop_duplicates=True, drop_autapses=True, db=None,
@@ -569,7 +684,8 @@ def get_neuron_connections(sources, targets=None, agglomerate=True,
         syn['post_close'] = False
         for id in np.unique(syn[['id_pre', 'id_post']].values.flatten()):
             neuron = unique_neurons.idx[id]
-            tree = navis.neuron2KDTree(neuron)
+            tree = navis.neuron2KDTree(neuron, balanced_tree=False,
+                                       compact_nodes=False)
 
             is_pre = syn.id_pre == id
             if np.any(is_pre):
@@ -589,31 +705,11 @@ def get_neuron_connections(sources, targets=None, agglomerate=True,
 
     # Drop duplicate connections, i.e. connections that connect the same pre-
     # and postsynaptic segmentation ID and are within a distance of 250nm
-    dupl_thresh = 250
     if drop_duplicates:
         # We are dealing with this from a presynaptic perspective
-        while True:
-            pre_tree = cKDTree(syn[['pre_x', 'pre_y', 'pre_z']].values)
-            pairs = pre_tree.query_pairs(r=dupl_thresh, output_type='ndarray')
-
-            same_pre = syn.iloc[pairs[:, 0]].segmentid_pre.values == syn.iloc[pairs[:, 1]].segmentid_pre.values
-            same_post = syn.iloc[pairs[:, 0]].segmentid_post.values == syn.iloc[pairs[:, 1]].segmentid_post.values
-            same_cn = same_pre & same_post
-
-            # If no more pairs to collapse break
-            if same_cn.sum() == 0:
-                break
-
-            # Generate a graph from pairs
-            G = nx.Graph()
-            G.add_edges_from(pairs[same_cn])
-
-            # Find the minimum number of nodes we need to remove
-            # to separate the connectors
-            to_rm = []
-            for cn in nx.connected_components(G):
-                to_rm += list(nx.minimum_node_cut(nx.subgraph(G, cn)))
-            syn = syn.drop(index=syn.index.values[to_rm])
+        syn = _drop_duplicate_synapses(syn,
+                                       loc_cols=[['pre_x', 'pre_y', 'pre_z']],
+                                       dist=250)
 
     if agglomerate:
         edges = syn.groupby(['id_pre', 'id_post'],
@@ -625,6 +721,66 @@ def get_neuron_connections(sources, targets=None, agglomerate=True,
     return syn
 
 
+def _drop_duplicate_synapses(syn, loc_cols, dist=250):
+    """Collapse clusters of duplicate synapses.
+
+    Two synapses are considered duplicates if they connect the same pair of
+    pre- and postsynaptic segment IDs and are within ``dist`` of each other
+    in any of the given sets of location columns. Of each cluster of
+    duplicates only the first synapse is kept.
+
+    Parameters
+    ----------
+    syn :       pd.DataFrame
+                Synapses. Must contain ``segmentid_pre``, ``segmentid_post``
+                and the ``loc_cols`` columns.
+    loc_cols :  list of lists
+                Sets of x/y/z columns to check distances for, e.g.
+                ``[['pre_x', 'pre_y', 'pre_z']]``.
+    dist :      int | float
+                Distance below which synapses are considered duplicates.
+
+    Returns
+    -------
+    pd.DataFrame
+                Subset of ``syn``.
+
+    """
+    # Only synapses connecting a pair of segment IDs that shows up more
+    # than once can have duplicates - no need to put the rest into trees
+    cand = syn.duplicated(['segmentid_pre', 'segmentid_post'], keep=False)
+    cand = np.flatnonzero(cand.values)
+
+    # Generate pairs of synapses that are suspiciously close. Removing
+    # synapses does not create new pairs, so a single query per tree is
+    # enough. For the same reason, we skip the expensive tree balancing
+    pairs = [cKDTree(syn[cols].values[cand],
+                     balanced_tree=False,
+                     compact_nodes=False).query_pairs(r=dist, output_type='ndarray')
+             for cols in loc_cols]
+    pairs = cand[np.vstack(pairs)]
+
+    # For each pair check if they connect the same IDs
+    seg_pre = syn.segmentid_pre.values
+    seg_post = syn.segmentid_post.values
+    same_cn = (seg_pre[pairs[:, 0]] == seg_pre[pairs[:, 1]]) \
+        & (seg_post[pairs[:, 0]] == seg_post[pairs[:, 1]])
+    pairs = pairs[same_cn]
+
+    if not pairs.shape[0]:
+        return syn
+
+    # Label clusters of duplicate synapses and keep only the first synapse in
+    # each cluster
+    adj = scipy.sparse.coo_matrix((np.ones(pairs.shape[0], dtype=bool),
+                                   (pairs[:, 0], pairs[:, 1])),
+                                  shape=(syn.shape[0], syn.shape[0]))
+    _, labels = scipy.sparse.csgraph.connected_components(adj, directed=False)
+    _, keep = np.unique(labels, return_index=True)
+
+    return syn.iloc[np.sort(keep)]
+
+
 def assign_connectors(synapses, max_dist=300):
     """Collapse synapses by presynaptic connectors.
 
@@ -674,7 +830,7 @@ def assign_connectors(synapses, max_dist=300):
 
         # Build KDTree and generate pairs
         this_locs = this[loc_cols].values
-        tree = cKDTree(this_locs)
+        tree = cKDTree(this_locs, balanced_tree=False, compact_nodes=False)
         pairs = tree.query_pairs(r=max_dist)
 
         # Generate graph from pairs
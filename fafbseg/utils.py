@@ -21,13 +21,30 @@ import warnings
 import numpy as np
 import trimesh as tm
 
-from functools import wraps
+from concurrent import futures
+from functools import partial, wraps
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse
+from urllib3.util.retry import Retry
 
 use_pbars = True
 
 SERVICE_URL = 'https://spine.janelia.org/app/transform-service'
 
+# Requests to spine go through a single session so that connections are
+# kept alive and reused instead of doing a new handshake for every request.
+# Transient gateway errors are retried - note that our requests are POSTs
+# which urllib3 would not retry by default
+SPINE_THREADS = 16
+spine_session = requests.Session()
+spine_session.mount('https://',
+                    HTTPAdapter(pool_connections=SPINE_THREADS,
+                                pool_maxsize=SPINE_THREADS,
+                                max_retries=Retry(total=3,
+                                                  backoff_factor=0.3,
+                                                  status_forcelist=(502, 503, 504),
+                                                  allowed_methods=None)))
+
 
 class OnDemandDict(dict):
     """Initialized with a just a URL.
@@ -143,6 +160,9 @@ def query_spine(x, dataset, query, coordinates='nm', mip=2,
                     Resolution of mapping. Lower = more precise but much slower.
     coordinates :   "nm" | "pixel"
                     Units of the provided coordinates in ``x``.
+    limit_request : int
+                    Max number of points per request. Larger queries are split
+                    into chunks which are sent in parallel.
     on_fail :       "warn" | "ignore" | "raise"
                     What to do if points failed to xform.
 
@@ -197,37 +217,40 @@ def query_spine(x, dataset, query, coordinates='nm', mip=2,
     # We need to convert to pixel coordinates
     # Note that we are rounding here to get to pixels
     # This will have the most impact on the Z section
+    # We go straight to float32 (which is what we send) instead of via int64:
+    # pixel coordinates are well within the range float32 represents exactly
     if coordinates in ['nm', 'nanometers', 'nanometer']:
-        x = np.round(x / [4, 4, 40]).astype(int)
+        x = np.round(x / [4, 4, 40]).astype(np.single)
 
     # Generate URL
     url = f'{SERVICE_URL}/{query}/dataset/{dataset}/s/{mip}/values_binary/format/array_float_Nx3'
 
+    # The service expects raw float32 (N, 3) arrays - convert only once so
+    # that each chunk below can be sent as is without further copies
+    x = np.ascontiguousarray(x, dtype=np.single)
+
     # Make sure we don't exceed the maximum size for each request
-    stack = []
     limit_request = int(limit_request)
-    for ix in np.arange(0, x.shape[0], limit_request):
-        this_x = x[ix: ix + limit_request]
+    chunks = [x[ix: ix + limit_request]
+              for ix in np.arange(0, x.shape[0], limit_request)]
 
-        # Make request
-        resp = requests.post(url,
-                             data=this_x.astype(np.single).tobytes(order='C'))
-
-        # Check for errors
-        resp.raise_for_status()
-
-        # Extract data
-        data = np.frombuffer(resp.content, dtype=dtypes[dataset])
-        if query == 'transform':
-            data = data.reshape(x.shape[0], 2)
-        stack.append(data)
+    # Requests are network-bound, so we can run them in parallel
+    with futures.ThreadPoolExecutor(max_workers=SPINE_THREADS) as ex:
+        stack = list(ex.map(partial(_query_spine_chunk,
+                                    url=url,
+                                    dtype=dtypes[dataset],
+                                    query=query),
+                            chunks))
 
     stack = np.concatenate(stack, axis=0)
 
-    # If mapping failed will contain NaNs
-    if on_fail != 'ignore':
-        is_nan = np.any(np.isnan(stack),
-                        axis=1 if stack.ndim == 2 else 0)
+    # If mapping failed will contain NaNs (IDs from queries can't be NaN)
+    if on_fail != 'ignore' and stack.dtype.kind == 'f':
+        if stack.ndim == 2:
+            # Elementwise OR over the (dx, dy) columns in a single pass
+            is_nan = np.isnan(stack[:, 0]) | np.isnan(stack[:, 1])
+        else:
+            is_nan = np.isnan(stack)
         if np.any(is_nan):
             msg = f'{is_nan.sum()} points failed to transform.'
             if on_fail == 'warn':
@@ -236,3 +259,22 @@ def query_spine(x, dataset, query, coordinates='nm', mip=2,
                 raise ValueError(msg)
 
     return stack
+
+
+def _query_spine_chunk(x, url, dtype, query):
+    """Send a single request to spine.
+
+    ``x`` must already be a C-contiguous float32 array.
+
+    """
+    resp = spine_session.post(url, data=x.tobytes(order='C'))
+
+    # Check for errors
+    resp.raise_for_status()
+
+    # Extract data
+    data = np.frombuffer(resp.content, dtype=dtype)
+    if query == 'transform':
+        data = data.reshape(x.shape[0], 2)
+
+    return data
@@ -156,44 +156,65 @@ def _flycon(x, dataset, base_url='https://spine.janelia.org/app/transform-servic
 
     """
     if isinstance(x, navis.NeuronList):
-        return x.__class__([_flycon(n,
-                                    dataset=dataset,
-                                    on_fail=on_fail,
-                                    coordinates=coordinates,
-                                    mip=mip,
-                                    base_url=base_url,
-                                    inplace=inplace) for n in x])
-    elif isinstance(x, (navis.BaseNeuron, navis.Volume, tm.Trimesh)):
         if not inplace:
             x = x.copy()
 
-        if isinstance(x, navis.TreeNeuron):
-            x.nodes[['x', 'y', 'z']] = _flycon(x.nodes[['x', 'y', 'z']].values,
-                                               dataset=dataset,
-                                               on_fail=on_fail,
-                                               coordinates=coordinates,
-                                               mip=mip,
-                                               base_url=base_url,
-                                               inplace=inplace)
-        elif isinstance(x, (navis.MeshNeuron, navis.Volume, tm.Trimesh)):
-            x.vertices = _flycon(x.vertices,
-                                 dataset=dataset,
-                                 on_fail=on_fail,
-                                 coordinates=coordinates,
-                                 mip=mip,
-                                 base_url=base_url,
-                                 inplace=inplace)
-        else:
-            raise TypeError(f'Unable to convert neuron of type "{type(x)}"')
+        # Collect coordinates across all neurons so that we can transform
+        # them in as few requests as possible
+        xyz = []
+        for n in x:
+            if isinstance(n, navis.TreeNeuron):
+                xyz.append(n.nodes[['x', 'y', 'z']].values)
+            elif isinstance(n, navis.MeshNeuron):
+                xyz.append(np.asarray(n.vertices))
+            else:
+                raise TypeError(f'Unable to convert neuron of type "{type(n)}"')
+
+            if n.has_connectors:
+                xyz.append(n.connectors[['x', 'y', 'z']].values)
+
+        if not xyz:
+            return x
+
+        xf = _flycon(np.vstack(xyz),
+                     dataset=dataset,
+                     on_fail=on_fail,
+                     coordinates=coordinates,
+                     mip=mip,
+                     base_url=base_url,
+                     inplace=inplace)
+
+        # Split the transformed coordinates up again
+        xf = iter(np.split(xf, np.cumsum([len(co) for co in xyz])[:-1]))
+        for n in x:
+            if isinstance(n, navis.TreeNeuron):
+                n.nodes[['x', 'y', 'z']] = next(xf)
+            else:
+                n.vertices = next(xf)
+
+            if n.has_connectors:
+                n.connectors[['x', 'y', 'z']] = next(xf)
+
+        return x
+    elif isinstance(x, navis.BaseNeuron):
+        return _flycon(navis.NeuronList(x),
+                       dataset=dataset,
+                       on_fail=on_fail,
+                       coordinates=coordinates,
+                       mip=mip,
+                       base_url=base_url,
+                       inplace=inplace)[0]
+    elif isinstance(x, (navis.Volume, tm.Trimesh)):
+        if not inplace:
+            x = x.copy()
 
-        if isinstance(x, navis.BaseNeuron) and x.has_connectors:
-            x.connectors[['x', 'y', 'z']] = _flycon(x.connectors[['x', 'y', 'z']].values,
-                                                    dataset=dataset,
-                                                    on_fail=on_fail,
-                                                    coordinates=coordinates,
-                                                    mip=mip,
-                                                    base_url=base_url,
-                                                    inplace=inplace)
+        x.vertices = _flycon(x.vertices,
+                             dataset=dataset,
+                             on_fail=on_fail,
+                             coordinates=coordinates,
+                             mip=mip,
+                             base_url=base_url,
+                             inplace=inplace)
 
         return x
 
@@ -204,10 +225,13 @@ def _flycon(x, dataset, base_url='https://spine.janelia.org/app/transform-servic
         raise ValueError(f'Expected coordinates of shape (N, 3), got {x.shape}')
 
     # This returns offsets along x and y axis
+    # Split large queries into smaller requests which query_spine sends in
+    # parallel
     offsets = utils.query_spine(x, dataset,
                                 query='transform',
                                 coordinates=coordinates,
                                 mip=mip,
+                                limit_request=5e4,
                                 on_fail=on_fail)
 
     # We need to cast x to the same type as offsets -> likely float 64
@@ -0,0 +1,77 @@
+import navis
+import numpy as np
+import pandas as pd
+
+from fafbseg.move import merge_utils
+
+
+def _make_neuron(seed, n_nodes, first_id, skid, start=(0, 0, 0)):
+    """Make a random-walk skeleton with a connector every 7th node."""
+    rng = np.random.default_rng(seed)
+    ids = np.arange(first_id, first_id + n_nodes)
+    xyz = np.cumsum(rng.normal(0, 200, (n_nodes, 3)), axis=0) + start
+    nodes = pd.DataFrame({'node_id': ids,
+                          'parent_id': np.r_[-1, ids[:-1]],
+                          'x': xyz[:, 0], 'y': xyz[:, 1], 'z': xyz[:, 2],
+                          'radius': 0})
+    n = navis.TreeNeuron(nodes, id=skid, name='n{}'.format(skid))
+    n.connectors = pd.DataFrame({'node_id': ids[::7],
+                                 'connector_id': ids[::7] + 10**6,
+                                 'type': 0,
+                                 'x': xyz[::7, 0],
+                                 'y': xyz[::7, 1],
+                                 'z': xyz[::7, 2]})
+    return n
+
+
+def _make_fragments(skid_type=int):
+    """Make two target fragments and a neuron A that traces the first one
+    (with a small offset) plus an extra arm."""
+    B1 = _make_neuron(1, 400, 1, skid_type(11))
+    B2 = _make_neuron(2, 300, 5000, skid_type(12),
+                      start=B1.nodes[['x', 'y', 'z']].values[-1])
+
+    dupl = B1.nodes.copy()
+    dupl['node_id'] += 100000
+    dupl.loc[dupl.parent_id >= 0, 'parent_id'] += 100000
+    dupl[['x', 'y', 'z']] += 150
+
+    arm = _make_neuron(3, 200, 200000, 99,
+                       start=B1.nodes[['x', 'y', 'z']].values[200])
+    arm.nodes.loc[0, 'parent_id'] = 100200
+
+    A = navis.TreeNeuron(pd.concat([dupl, arm.nodes]), id=skid_type(99),
+                         name='A')
+    A.connectors = arm.connectors
+
+    return A, navis.NeuronList([B1, B2]), B1
+
+
+def test_collapse_nodes_new_edges_string_ids():
+    # pymaid's skeleton IDs are strings - new edges must not depend on that
+    res = {}
+    for skid_type in (int, str):
+        A, B, B1 = _make_fragments(skid_type)
+        union, new_edges, _ = merge_utils.collapse_nodes(A, B, limit=0.5,
+                                                         base_neuron=B1)
+        res[skid_type] = new_edges
+
+        # Only edges between different skeletons are new
+        assert new_edges.shape[0] < 20
+        assert all(new_edges.origin_skeletons != new_edges.parent_skeleton)
+        assert union.nodes.parent_skeleton.isnull().sum() == 1
+
+    assert np.array_equal(np.sort(res[int].node_id.values),
+                          np.sort(res[str].node_id.values))
+
+
+def test_collapse_nodes_tags_deduplicated():
+    A, B, B1 = _make_fragments()
+    # A's nodes 100010 and 100011 collapse into B1's nodes 10 and 11
+    A.tags = {'foo': [100010, 100011]}
+    B1.tags = {'foo': [10]}
+    union, _, clps_map = merge_utils.collapse_nodes(A, B, limit=0.5,
+                                                    base_neuron=B1)
+
+    assert clps_map[100010] == 10
+    assert sorted(union.tags['foo']) == [10, 11]